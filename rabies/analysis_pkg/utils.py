@@ -15,7 +15,7 @@ def resample_prior_maps(in_file, ref_file, transforms = [], inverses = []):
     warped_volumes = []
     for x in range(0, num_volumes):
         warped_vol_fname = os.path.abspath(
-            "deformed_volume" + str(x) + ".nii.gz")
+            "deformed_volume" + str(x) + ".nii")
         warped_volumes.append(warped_vol_fname)
         exec_applyTransforms(transforms=transforms, inverses=inverses, input_image=volumes_list[x], ref_image=ref_file, output_image=warped_vol_fname, interpolation='Linear')
 
@@ -228,11 +228,12 @@ class Regress(BaseInterface):
         volume_indices = brain_mask.astype(bool)
 
         data_img = sitk.ReadImage(bold_file, sitk.sitkFloat32)
-        data_array = sitk.GetArrayFromImage(data_img)
-        num_volumes = data_array.shape[0]
-        timeseries = np.zeros([num_volumes, volume_indices.sum()])
-        for i in range(num_volumes):
-            timeseries[i, :] = (data_array[i, :, :, :])[volume_indices]
+        # the masked voxels are copied from a view of the image directly into the float64 timeseries,
+        # without an intermediate copy of the 4D array or of the float32 masked timeseries
+        data_array = sitk.GetArrayViewFromImage(data_img)
+        timeseries = np.empty([data_array.shape[0], volume_indices.sum()])
+        for i in range(data_array.shape[0]):
+            timeseries[i, :] = data_array[i][volume_indices]
         timeseries = timeseries[time_range,:]
 
         if cr_opts.TR=='auto':
@@ -319,11 +320,10 @@ class Regress(BaseInterface):
             setattr(self, 'aroma_out', aroma_out)
 
             data_img = sitk.ReadImage(cleaned_file, sitk.sitkFloat32)
-            data_array = sitk.GetArrayFromImage(data_img)
-            num_volumes = data_array.shape[0]
-            timeseries = np.zeros([num_volumes, volume_indices.sum()])
-            for i in range(num_volumes):
-                timeseries[i, :] = (data_array[i, :, :, :])[volume_indices]
+            data_array = sitk.GetArrayViewFromImage(data_img)
+            timeseries = np.empty([data_array.shape[0], volume_indices.sum()])
+            for i in range(data_array.shape[0]):
+                timeseries[i, :] = data_array[i][volume_indices]
 
         if (not cr_opts.highpass is None) or (not cr_opts.lowpass is None):
             '''
@@ -1,4 +1,5 @@
 import os
+import re
 import numpy as np
 import SimpleITK as sitk
 from rabies.analysis_pkg.analysis_math import closed_form
@@ -12,12 +13,14 @@ def tree_list(dirName):
     return listOfFiles
 
 
+# matches the filename up to the first '_run-' specification, followed by the run's first character
+run_info_regex = re.compile(r'^.*?_run-.')
+
+
 def get_info_list(file_list):
     info_list = []
     for file in file_list:
-        basename = os.path.basename(file)
-        file_info = basename.split(
-            '_run-')[0]+'_run-'+basename.split('_run-')[1][0]
+        file_info = run_info_regex.match(os.path.basename(file)).group(0)
         info_list.append(file_info)
 
     return info_list
@@ -195,13 +198,25 @@ def compute_signal_regressors(timeseries,volume_indices, conf_list,brain_mask_fi
     # make sure there are no NaN voxels
     timeseries[np.isnan(timeseries)] = 0
 
-    regressors_array = np.empty([timeseries.shape[0],0])
+    # each mask file is read only once, since the WM/CSF masks are shared between the signal and aCompCor regressors
+    mask_arrays = {}
+    def read_mask(mask_file):
+        if not mask_file in mask_arrays:
+            mask_arrays[mask_file] = sitk.GetArrayFromImage(sitk.ReadImage(mask_file, sitk.sitkFloat32))
+        return mask_arrays[mask_file]
+
+    regressors_list = []
     for conf,mask_file in zip(['WM_signal','CSF_signal','vascular_signal','global_signal'],
                                 [WM_mask_file,CSF_mask_file,vascular_mask_file,brain_mask_file]):
         if conf in conf_list:
-            mask_idx = sitk.GetArrayFromImage(sitk.ReadImage(mask_file, sitk.sitkFloat32)).astype(bool)
-            regressor_trace = timeseries.T[mask_idx[volume_indices]].mean(axis=0)
-            regressors_array = np.append(regressors_array,regressor_trace.reshape(-1,1),axis=1)
+            if conf == 'global_signal':
+                # the timeseries are already restricted to the brain mask, so the global signal is their mean
+                regressor_trace = timeseries.mean(axis=1)
+            else:
+                # the mean over mask voxels is computed as a single matrix-vector product, without copying the masked voxels
+                mask_vector = read_mask(mask_file)[volume_indices].astype(bool).astype(timeseries.dtype)
+                regressor_trace = timeseries.dot(mask_vector)/mask_vector.sum()
+            regressors_list.append(regressor_trace.reshape(-1,1))
     
     if ('aCompCor_5' in conf_list) or ('aCompCor_percent' in conf_list):
         if ('aCompCor_5' in conf_list) and ('aCompCor_percent' in conf_list):
@@ -215,33 +230,39 @@ def compute_signal_regressors(timeseries,volume_indices, conf_list,brain_mask_fi
             raise
 
         from sklearn.decomposition import PCA
-        WM_mask_idx = sitk.GetArrayFromImage(sitk.ReadImage(WM_mask_file, sitk.sitkFloat32))
-        CSF_mask_idx = sitk.GetArrayFromImage(sitk.ReadImage(CSF_mask_file, sitk.sitkFloat32))
+        WM_mask_idx = read_mask(WM_mask_file)
+        CSF_mask_idx = read_mask(CSF_mask_file)
         combined_mask_idx = (WM_mask_idx+CSF_mask_idx) > 0
 
         masked_timeseries = timeseries[:,combined_mask_idx[volume_indices]]
 
         if method == 'aCompCor_percent':
-            pca = PCA()
-            pca.fit(masked_timeseries)
-            explained_variance = pca.explained_variance_ratio_
-            cum_var = 0
-            num_comp = 0
+            # few components are needed to explain 50% of the variance, so a truncated randomized SVD is fit first
+            max_comp = min(50, *masked_timeseries.shape)
+            pca = PCA(n_components=max_comp, svd_solver='randomized', random_state=0)
+            comp_timeseries = pca.fit_transform(masked_timeseries)
+            cum_var = np.cumsum(pca.explained_variance_ratio_)
+            if cum_var[-1] <= 0.5:
+                # fall back on the full decomposition if the truncated components don't reach 50% of the variance
+                pca = PCA(svd_solver='full')
+                comp_timeseries = pca.fit_transform(masked_timeseries)
+                cum_var = np.cumsum(pca.explained_variance_ratio_)
             # evaluate the # of components to explain 50% of the variance
-            while(cum_var <= 0.5):
-                cum_var += explained_variance[num_comp]
-                num_comp += 1
+            num_comp = int(np.searchsorted(cum_var, 0.5, side='right'))+1
             from nipype import logging
             log = logging.getLogger('nipype.workflow')
             log.info("Extracting "+str(num_comp)+" components for aCompCorr.")
+            # the leading components are kept from the same fit instead of fitting the PCA again
+            comp_timeseries = comp_timeseries[:,:num_comp]
 
         elif method == 'aCompCor_5':
-            num_comp = 5
+            pca = PCA(n_components=5, svd_solver='randomized', random_state=0)
+            comp_timeseries = pca.fit_transform(masked_timeseries)
 
-        pca = PCA(n_components=num_comp)
-        comp_timeseries = pca.fit_transform(masked_timeseries)
-        regressors_array = np.append(regressors_array,comp_timeseries,axis=1)
+        regressors_list.append(comp_timeseries)
 
+    # all regressors are concatenated at once into a single array
+    regressors_array = np.concatenate([np.empty([timeseries.shape[0],0])]+regressors_list, axis=1)
     return regressors_array
 
 
@@ -214,10 +214,17 @@ def init_bold_main_wf(opts, output_folder, number_functional_scans, inho_cor_onl
                 from rabies.utils import copyInfo_4DImage
                 from rabies.preprocess_pkg.bold_ref import _get_vols_to_discard
 
-                in_nii = sitk.ReadImage(bold_file)
-                data_array = sitk.GetArrayFromImage(in_nii)
-                n_volumes_to_discard = _get_vols_to_discard(in_nii)
+                # only the first volumes are read to detect dummy scans
+                reader = sitk.ImageFileReader()
+                reader.SetFileName(bold_file)
+                reader.ReadImageInformation()
+                size = list(reader.GetSize())
+                reader.SetExtractIndex([0, 0, 0, 0])
+                reader.SetExtractSize(size[:3]+[min(50, size[3])])
+                n_volumes_to_discard = _get_vols_to_discard(reader.Execute())
                 if (not n_volumes_to_discard == 0):
+                    in_nii = sitk.ReadImage(bold_file)
+                    data_array = sitk.GetArrayViewFromImage(in_nii)
                     filename_split = pathlib.Path(bold_file).name.rsplit(".nii")
                     out_bold_file = os.path.abspath(
                         f'{filename_split[0]}_cropped_dummy.nii.gz')
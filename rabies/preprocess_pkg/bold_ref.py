@@ -52,8 +52,10 @@ def init_bold_reference_wf(opts, name='gen_bold_ref'):
         niu.IdentityInterface(fields=['ref_image']),
         name='outputnode')
 
-    gen_ref = pe.Node(EstimateReferenceImage(HMC_option=opts.HMC_option, detect_dummy=opts.detect_dummy, rabies_data_type=opts.data_type),
-                      name='gen_ref', mem_gb=2*opts.scale_min_memory)
+    # the motion realignment runs with all the threads allocated to the workflow, and MultiProc schedules the node accordingly
+    gen_ref_n_procs = opts.local_threads
+    gen_ref = pe.Node(EstimateReferenceImage(HMC_option=opts.HMC_option, detect_dummy=opts.detect_dummy, rabies_data_type=opts.data_type, num_threads=gen_ref_n_procs),
+                      name='gen_ref', mem_gb=2*opts.scale_min_memory, n_procs=gen_ref_n_procs)
     gen_ref.plugin_args = {
         'qsub_args': f'-pe smp {str(2*opts.min_proc)}', 'overwrite': True}
 
@@ -74,6 +76,8 @@ class EstimateReferenceImageInputSpec(BaseInterfaceInputSpec):
         desc="specify if should detect and remove dummy scans, and use these volumes as reference image.")
     rabies_data_type = traits.Int(mandatory=True,
                                   desc="Integer specifying SimpleITK data type.")
+    num_threads = traits.Int(1, usedefault=True,
+                             desc="Number of ITK threads used for motion realignment.")
 
 class EstimateReferenceImageOutputSpec(TraitedSpec):
     ref_image = File(exists=True, desc="3D reference image")
@@ -104,9 +108,14 @@ class EstimateReferenceImage(BaseInterface):
         if not in_nii.GetDimension()==4:
             raise ValueError(f"Input image {self.inputs.in_file} is not 4-dimensional.")
 
-        data_array = sitk.GetArrayFromImage(in_nii)
+        # a view avoids copying the whole timeseries; only the selected volumes are copied below
+        data_array = sitk.GetArrayViewFromImage(in_nii)
 
-        n_volumes_to_discard = _get_vols_to_discard(in_nii)
+        # the dummy scan detection is only needed if dummy volumes are used for the reference
+        if self.inputs.detect_dummy:
+            n_volumes_to_discard = _get_vols_to_discard(in_nii)
+        else:
+            n_volumes_to_discard = 0
 
         filename_split = pathlib.Path(self.inputs.in_file).name.rsplit(".nii")
         out_ref_fname = os.path.abspath(
@@ -115,8 +124,8 @@ class EstimateReferenceImage(BaseInterface):
         if (not n_volumes_to_discard == 0) and self.inputs.detect_dummy:
             log.info("Detected "+str(n_volumes_to_discard)
                   + " dummy scans. Taking the median of these volumes as reference EPI.")
-            median_image_data = np.median(
-                data_array[:n_volumes_to_discard, :, :, :], axis=0)
+            median_image_data = _median_across_volumes(
+                data_array[:n_volumes_to_discard, :, :, :])
 
         else:
             n_volumes_to_discard = 0
@@ -131,32 +140,35 @@ class EstimateReferenceImage(BaseInterface):
             subset_idx = np.linspace(0,num_timepoints-1,50).astype(int)
             data_slice = data_array[subset_idx,:,:,:]
             if num_timepoints > 50:
-                slice_fname = os.path.abspath("slice.nii.gz")
+                slice_fname = os.path.abspath("slice.nii")
                 image_4d = copyInfo_4DImage(sitk.GetImageFromArray(
                     data_slice, isVector=False), in_nii, in_nii)
                 sitk.WriteImage(image_4d, slice_fname)
             else:
                 slice_fname = self.inputs.in_file
 
-            median_fname = os.path.abspath("median.nii.gz")
+            median_fname = os.path.abspath("median.nii")
+            # float32 precision is sufficient for the intermediate registration targets
             image_3d = copyInfo_3DImage(sitk.GetImageFromArray(
-                np.median(data_slice, axis=0), isVector=False), in_nii)
+                _median_across_volumes(data_slice).astype(np.float32, copy=False), isVector=False), in_nii)
             sitk.WriteImage(image_3d, median_fname)
+            del data_slice
 
             # First iteration to generate reference image.
             res = antsMotionCorr(in_file=slice_fname,
-                                 ref_file=median_fname, prebuilt_option=self.inputs.HMC_option, transform_type='Rigid', second=False, rabies_data_type=self.inputs.rabies_data_type).run()
+                                 ref_file=median_fname, prebuilt_option=self.inputs.HMC_option, transform_type='Rigid', second=False, rabies_data_type=self.inputs.rabies_data_type, num_threads=self.inputs.num_threads).run()
 
-            median = np.median(sitk.GetArrayFromImage(sitk.ReadImage(
-                res.outputs.mc_corrected_bold, self.inputs.rabies_data_type)), axis=0)
-            tmp_median_fname = os.path.abspath("tmp_median.nii.gz")
+            mc_img = sitk.ReadImage(res.outputs.mc_corrected_bold, self.inputs.rabies_data_type)
+            median = _median_across_volumes(sitk.GetArrayViewFromImage(mc_img))
+            del mc_img
+            tmp_median_fname = os.path.abspath("tmp_median.nii")
             image_3d = copyInfo_3DImage(
-                sitk.GetImageFromArray(median, isVector=False), in_nii)
+                sitk.GetImageFromArray(median.astype(np.float32, copy=False), isVector=False), in_nii)
             sitk.WriteImage(image_3d, tmp_median_fname)
 
             # Second iteration to generate reference image.
             res = antsMotionCorr(in_file=slice_fname,
-                                 ref_file=tmp_median_fname, prebuilt_option=self.inputs.HMC_option, transform_type='Rigid', second=True,  rabies_data_type=self.inputs.rabies_data_type).run()
+                                 ref_file=tmp_median_fname, prebuilt_option=self.inputs.HMC_option, transform_type='Rigid', second=True,  rabies_data_type=self.inputs.rabies_data_type, num_threads=self.inputs.num_threads).run()
 
             # evaluate a trimmed mean instead of a median, trimming the 5% extreme values
             from scipy import stats
@@ -164,9 +176,9 @@ class EstimateReferenceImage(BaseInterface):
                 res.outputs.mc_corrected_bold, self.inputs.rabies_data_type)), 0.05, axis=0)
 
         # median_image_data is a 3D array of the median image, so creates a new nii image
-        # saves it
+        # saves it as float32, since it is re-written in float precision by DenoiseImage
         image_3d = copyInfo_3DImage(sitk.GetImageFromArray(
-            median_image_data, isVector=False), in_nii)
+            median_image_data.astype(np.float32, copy=False), isVector=False), in_nii)
         sitk.WriteImage(image_3d, out_ref_fname)
 
         # denoise the resulting reference image through non-local mean denoising
@@ -182,12 +194,26 @@ class EstimateReferenceImage(BaseInterface):
         return {'ref_image': getattr(self, 'ref_image')}
 
 
+def _median_across_volumes(data_array):
+    '''
+    Takes a 4D array ordered as (volumes,z,y,x) from SimpleITK and computes the voxelwise median across volumes.
+    The median is computed one z slice at a time: each slice is reordered so that the timeseries of each voxel
+    is contiguous in memory, and the median is then partitioned in place along that last axis.
+    '''
+    median_slices = []
+    for z in range(data_array.shape[1]):
+        voxel_timeseries = np.ascontiguousarray(np.moveaxis(data_array[:, z, :, :], 0, -1))
+        median_slices.append(np.median(voxel_timeseries, axis=-1, overwrite_input=True))
+    return np.stack(median_slices, axis=0)
+
+
 def _get_vols_to_discard(img):
     '''
     Takes a nifti file, extracts the mean signal of the first 50 volumes and computes which are outliers.
     is_outlier function: computes Modified Z-Scores (https://www.itl.nist.gov/div898/handbook/eda/section3/eda35h.htm) to determine which volumes are outliers.
     '''
     from nipype.algorithms.confounds import is_outlier
-    data_slice = sitk.GetArrayFromImage(img)[:50, :, :, :]
-    global_signal = data_slice.mean(axis=-1).mean(axis=-1).mean(axis=-1)
+    # the first volumes are accessed through a view, and each volume is reduced in a single pass
+    data_slice = sitk.GetArrayViewFromImage(img)[:50, :, :, :]
+    global_signal = data_slice.reshape(data_slice.shape[0], -1).mean(axis=1, dtype=np.float64)
     return is_outlier(global_signal)
@@ -6,7 +6,7 @@ from nipype.interfaces.base import (
     traits, TraitedSpec, BaseInterfaceInputSpec,
     File, BaseInterface
 )
-from rabies.utils import run_command
+from rabies.utils import run_command, read_image_info
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 
@@ -58,8 +58,10 @@ def init_bold_hmc_wf(opts, name='bold_hmc_wf'):
         name='outputnode')
 
     # Head motion correction (hmc)
-    motion_estimation = pe.Node(antsMotionCorr(prebuilt_option=opts.HMC_option,transform_type='Rigid', second=False, rabies_data_type=opts.data_type),
-                         name='ants_MC', mem_gb=1.1*opts.scale_min_memory)
+    # antsMotionCorr runs with all the threads allocated to the workflow, and MultiProc schedules the node accordingly
+    hmc_n_procs = opts.local_threads
+    motion_estimation = pe.Node(antsMotionCorr(prebuilt_option=opts.HMC_option,transform_type='Rigid', second=False, rabies_data_type=opts.data_type, num_threads=hmc_n_procs),
+                         name='ants_MC', mem_gb=1.1*opts.scale_min_memory, n_procs=hmc_n_procs)
     motion_estimation.plugin_args = {
         'qsub_args': f'-pe smp {str(3*opts.min_proc)}', 'overwrite': True}
 
@@ -99,6 +101,8 @@ class antsMotionCorrInputSpec(BaseInterfaceInputSpec):
     second = traits.Bool(desc="specify if it is the second iteration")
     rabies_data_type = traits.Int(mandatory=True,
                                   desc="Integer specifying SimpleITK data type.")
+    num_threads = traits.Int(1, usedefault=True,
+                             desc="Number of ITK threads used by antsMotionCorr.")
 
 
 class antsMotionCorrOutputSpec(TraitedSpec):
@@ -142,8 +146,9 @@ class antsMotionCorr(BaseInterface):
             if moreaccurate not in [0, 1, 2, 3]:
                 raise ValueError("Wrong pre-built option provided.")
 
-        img = sitk.ReadImage(moving, self.inputs.rabies_data_type)
-        ref_img = sitk.ReadImage(fixed, self.inputs.rabies_data_type)
+        # only the image headers are needed to set the registration parameters
+        img = read_image_info(moving)
+        ref_img = read_image_info(fixed)
 
         n = img.GetSize()[3]
         if (n > 10):
@@ -212,6 +217,9 @@ class antsMotionCorr(BaseInterface):
                 raise ValueError("No smoothing coefficient was found.")
         else:
             raise ValueError("Wrong moreaccurate provided.")
+
+        # run with the number of threads allocated to the node
+        command = f'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS={self.inputs.num_threads} '+command
         rc,c_out = run_command(command)
 
         setattr(self, 'csv_params', os.path.abspath('ants_mc_tmp/motcorrMOCOparams.csv'))
@@ -408,12 +416,10 @@ class EstimateMotionParams(BaseInterface):
         FD_voxelwise = os.path.abspath(f"{filename_split[0]}_FD_file.nii.gz")
 
         motion_24,motion_24_header = motion_24_params(self.inputs.motcorr_params)
-        # write into a .csv
-        import pandas as pd
-        df = pd.DataFrame(motion_24)
-        df.columns = motion_24_header
+        # write into a .csv, with a leading index column as in the pandas format
         motion_params_csv = os.path.abspath(f"{filename_split[0]}_motion_params.csv")
-        df.to_csv(motion_params_csv)
+        np.savetxt(motion_params_csv, np.column_stack((np.arange(motion_24.shape[0]), motion_24)),
+                   fmt=['%d']+['%.17g']*motion_24.shape[1], delimiter=',', header=','+','.join(motion_24_header), comments='')
 
         setattr(self, 'FD_csv', FD_csv)
         setattr(self, 'motion_params_csv', motion_params_csv)
@@ -438,16 +444,14 @@ def motion_24_params(movpar_csv):
     rotations = rigid_params[:,:3] # rotations are listed first
     translations = rigid_params[:,3:] # translations are last
 
-    movpar = np.zeros([np.size(rigid_params, 0), 24])
+    movpar = np.empty([np.size(rigid_params, 0), 24])
     movpar[:, :3] = translations # add rotations first
     movpar[:, 3:6] = rotations # rotations second
-    for i in range(6):
-        # Compute temporal derivative as difference between two neighboring points
-        movpar[0, 6+i] = 0
-        movpar[1:, 6+i] = movpar[1:, i]-movpar[:-1, i]
-        # add the squared coefficients
-        movpar[:, 12+i] = movpar[:, i]**2
-        movpar[:, 18+i] = movpar[:, 6+i]**2
+    # Compute temporal derivative as difference between two neighboring points
+    movpar[0, 6:12] = 0
+    np.subtract(movpar[1:, :6], movpar[:-1, :6], out=movpar[1:, 6:12])
+    # add the squared coefficients of both the parameters and derivatives in a single pass
+    np.square(movpar[:, :12], out=movpar[:, 12:24])
 
     motion_24_header = ['mov1', 'mov2', 'mov3', 'rot1', 'rot2', 'rot3', 'mov1_der', 'mov2_der', 'mov3_der', 'rot1_der', 'rot2_der', 'rot3_der',
                     'mov1^2', 'mov2^2', 'mov3^2', 'rot1^2', 'rot2^2', 'rot3^2', 'mov1_der^2', 'mov2_der^2', 'mov3_der^2', 'rot1_der^2', 'rot2_der^2', 'rot3_der^2']
@@ -457,16 +461,5 @@ def motion_24_params(movpar_csv):
 
 def extract_rigid_movpar(movpar_csv):
     import numpy as np
-    import csv
-    temp = []
-    with open(movpar_csv) as csvfile:
-        motcorr = csv.reader(csvfile, delimiter=',', quotechar='|')
-        for row in motcorr:
-            temp.append(row)
-    movpar = np.zeros([(len(temp)-1), 6])
-    j = 0
-    for row in temp[1:]:
-        for i in range(2, len(row)):
-            movpar[j, i-2] = float(row[i])
-        j = j+1
-    return movpar
+    # the first 2 columns are the metric values, followed by the 6 rigid parameters
+    return np.loadtxt(movpar_csv, delimiter=',', skiprows=1, usecols=range(2, 8), ndmin=2)
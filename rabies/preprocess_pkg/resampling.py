@@ -80,40 +80,51 @@ def init_bold_preproc_trans_wf(opts, resampling_dim, name='bold_native_trans_wf'
             fields=['bold', 'bold_ref', 'brain_mask', 'WM_mask', 'CSF_mask', 'vascular_mask', 'labels', 'raw_brain_mask']),
         name='outputnode')
 
+    bold_transform_n_procs = int(opts.local_threads/4)+1
+    if opts.apply_slice_mc:
+        # without motion realignment, antsApplyTransforms holds the whole 4D input and output at once,
+        # in single precision unless float64 is selected as data type
+        import SimpleITK as sitk
+        if opts.data_type == sitk.sitkFloat64:
+            bold_transform_mem_gb = 8*opts.scale_min_memory
+        else:
+            bold_transform_mem_gb = 4*opts.scale_min_memory
+    else:
+        bold_transform_mem_gb = 1*opts.scale_min_memory
     bold_transform = pe.Node(slice_applyTransforms(
-        rabies_data_type=opts.data_type), name='bold_transform', mem_gb=1*opts.scale_min_memory)
+        rabies_data_type=opts.data_type, n_procs=bold_transform_n_procs), name='bold_transform', mem_gb=bold_transform_mem_gb, n_procs=bold_transform_n_procs)
     bold_transform.inputs.apply_motcorr = (not opts.apply_slice_mc)
     bold_transform.inputs.resampling_dim = resampling_dim
     bold_transform.inputs.interpolation = opts.interpolation
 
-    merge = pe.Node(Merge(rabies_data_type=opts.data_type, clip_negative=True), name='merge', mem_gb=4*opts.scale_min_memory)
+    merge = pe.Node(Merge(rabies_data_type=opts.data_type, clip_negative=True, n_procs=bold_transform_n_procs), name='merge', mem_gb=4*opts.scale_min_memory, n_procs=bold_transform_n_procs)
     merge.plugin_args = {
         'qsub_args': f'-pe smp {str(3*opts.min_proc)}', 'overwrite': True}
 
     # Generate a new BOLD reference
     bold_reference_wf = init_bold_reference_wf(opts=opts)
 
-    WM_mask_to_EPI = pe.Node(MaskEPI(), name='WM_mask_EPI')
+    WM_mask_to_EPI = pe.Node(MaskEPI(), name='WM_mask_EPI', n_procs=1)
     WM_mask_to_EPI.inputs.name_spec = 'EPI_WM_mask'
     WM_mask_to_EPI.inputs.mask = str(opts.WM_mask)
 
-    CSF_mask_to_EPI = pe.Node(MaskEPI(), name='CSF_mask_EPI')
+    CSF_mask_to_EPI = pe.Node(MaskEPI(), name='CSF_mask_EPI', n_procs=1)
     CSF_mask_to_EPI.inputs.name_spec = 'EPI_CSF_mask'
     CSF_mask_to_EPI.inputs.mask = str(opts.CSF_mask)
 
-    vascular_mask_to_EPI = pe.Node(MaskEPI(), name='vascular_mask_EPI')
+    vascular_mask_to_EPI = pe.Node(MaskEPI(), name='vascular_mask_EPI', n_procs=1)
     vascular_mask_to_EPI.inputs.name_spec = 'EPI_vascular_mask'
     vascular_mask_to_EPI.inputs.mask = str(opts.vascular_mask)
 
-    brain_mask_to_EPI = pe.Node(MaskEPI(), name='Brain_mask_EPI')
+    brain_mask_to_EPI = pe.Node(MaskEPI(), name='Brain_mask_EPI', n_procs=1)
     brain_mask_to_EPI.inputs.name_spec = 'EPI_brain_mask'
     brain_mask_to_EPI.inputs.mask = str(opts.brain_mask)
 
-    propagate_labels = pe.Node(MaskEPI(), name='prop_labels_EPI')
+    propagate_labels = pe.Node(MaskEPI(), name='prop_labels_EPI', n_procs=1)
     propagate_labels.inputs.name_spec = 'EPI_anat_labels'
     propagate_labels.inputs.mask = str(opts.labels)
 
-    raw_brain_mask = pe.Node(MaskEPI(), name='raw_brain_mask')
+    raw_brain_mask = pe.Node(MaskEPI(), name='raw_brain_mask', n_procs=1)
     raw_brain_mask.inputs.name_spec = 'raw_brain_mask'
     raw_brain_mask.inputs.mask = str(opts.brain_mask)
 
@@ -212,7 +223,6 @@ class MaskEPI(BaseInterface):
 
     def _run_interface(self, runtime):
         import os
-        import SimpleITK as sitk
         from rabies.utils import exec_applyTransforms
 
         import pathlib  # Better path manipulation
@@ -225,9 +235,9 @@ class MaskEPI(BaseInterface):
         else:
             new_mask_path = os.path.abspath(f'{filename_split[0]}_{self.inputs.name_spec}.nii.gz')
 
-        exec_applyTransforms(self.inputs.transforms, self.inputs.inverses, self.inputs.mask, self.inputs.ref_EPI, new_mask_path, interpolation='GenericLabel')
-        sitk.WriteImage(sitk.ReadImage(
-            new_mask_path, sitk.sitkInt16), new_mask_path)
+        # the mask nodes are independent and can run in parallel, so each resampling is kept to a single thread;
+        # the mask is written as int16 directly by antsApplyTransforms
+        exec_applyTransforms(self.inputs.transforms, self.inputs.inverses, self.inputs.mask, self.inputs.ref_EPI, new_mask_path, interpolation='GenericLabel', num_threads=1, output_data_type='short')
 
         setattr(self, 'EPI_mask', new_mask_path)
         return runtime
@@ -1,4 +1,5 @@
 import os
+import functools
 import pathlib  # Better path manipulation
 import SimpleITK as sitk
 import numpy as np
@@ -12,8 +13,20 @@ from nipype.interfaces.base import (
 ######################
 
 
+@functools.lru_cache(maxsize=8)
+def _read_cached_image(filename, mtime, size):
+    return sitk.ReadImage(filename)
+
+
+def read_mask_image(mask_file):
+    # masks are re-read for every map recovered from a scan; the image is cached, and the
+    # file's modification time and size are part of the key so that a rewritten file is read again
+    stat = os.stat(mask_file)
+    return _read_cached_image(os.path.abspath(mask_file), stat.st_mtime_ns, stat.st_size)
+
+
 def recover_3D(mask_file, vector_map):
-    mask_img = sitk.ReadImage(mask_file)
+    mask_img = read_mask_image(mask_file)
     brain_mask = sitk.GetArrayFromImage(mask_img)
     volume_indices=brain_mask.astype(bool)
     volume=np.zeros(brain_mask.shape)
@@ -25,17 +38,16 @@ def recover_3D(mask_file, vector_map):
 
 def recover_4D(mask_file, vector_maps, ref_4d):
     #vector maps of shape num_volumeXnum_voxel
-    mask_img = sitk.ReadImage(mask_file)
+    mask_img = read_mask_image(mask_file)
     brain_mask = sitk.GetArrayFromImage(mask_img)
     volume_indices=brain_mask.astype(bool)
     shape=(vector_maps.shape[0],brain_mask.shape[0],brain_mask.shape[1],brain_mask.shape[2])
-    volumes=np.zeros(shape)
-    for i in range(vector_maps.shape[0]):
-        volume=volumes[i,:,:,:]
-        volume[volume_indices]=vector_maps[i,:]
-        volumes[i,:,:,:]=volume
+    # the volumes keep the data type of the input timeseries instead of defaulting to float64
+    volumes=np.zeros(shape, dtype=vector_maps.dtype)
+    # the mask indexes the spatial dimensions, so all volumes are filled at once
+    volumes[:,volume_indices]=vector_maps
     volume_img = copyInfo_4DImage(sitk.GetImageFromArray(
-        volumes, isVector=False), mask_img, sitk.ReadImage(ref_4d))
+        volumes, isVector=False), mask_img, read_image_info(ref_4d))
     return volume_img
 
 
@@ -101,6 +113,15 @@ def resample_image_spacing_4d(image_4d, output_spacing, clip_negative=True):
     return resampled_4d
 
 
+def read_image_info(filename):
+    # reads only the header of an image; the returned reader provides GetSize, GetSpacing, GetOrigin,
+    # GetDirection and GetDimension like an image, without loading the voxel data
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(filename)
+    reader.ReadImageInformation()
+    return reader
+
+
 def copyInfo_4DImage(image_4d, ref_3d, ref_4d):
     # function to establish metadata of an input 4d image. The ref_3d will provide
     # the information for the first 3 dimensions, and the ref_4d for the 4th.
@@ -159,6 +180,8 @@ class slice_applyTransformsInputSpec(BaseInterfaceInputSpec):
         desc="Select the interpolator for antsApplyTransform.")
     rabies_data_type = traits.Int(mandatory=True,
                                   desc="Integer specifying SimpleITK data type.")
+    n_procs = traits.Int(1, usedefault=True,
+                         desc="Number of processors available to resample volumes in parallel.")
 
 
 class slice_applyTransformsOutputSpec(TraitedSpec):
@@ -171,6 +194,8 @@ class slice_applyTransforms(BaseInterface):
     This interface will apply a set of transforms to an input 4D EPI as well as motion realignment if specified.
     Susceptibility distortion correction can be applied through the provided transforms. A list of the corrected
     single volumes will be provided as outputs, and these volumes require to be merged to recover timeseries.
+    Without motion realignment, the timeseries is resampled in a single call and the list contains only the
+    corrected 4D image.
     """
 
     input_spec = slice_applyTransformsInputSpec
@@ -179,7 +204,7 @@ class slice_applyTransforms(BaseInterface):
     def _run_interface(self, runtime):
         # resampling the reference image to the dimension of the EPI
 
-        img = sitk.ReadImage(self.inputs.in_file, self.inputs.rabies_data_type)
+        img = read_image_info(self.inputs.in_file)
 
         if not self.inputs.resampling_dim == 'inputs_defined':
             shape = self.inputs.resampling_dim.split('x')
@@ -188,38 +213,38 @@ class slice_applyTransforms(BaseInterface):
             spacing = img.GetSpacing()[:3]
         resampled = resample_image_spacing(sitk.ReadImage(
             self.inputs.ref_file, self.inputs.rabies_data_type), spacing)
-        sitk.WriteImage(resampled, 'resampled.nii.gz')
+        # the reference is read by every antsApplyTransforms call, so it is written uncompressed
+        sitk.WriteImage(resampled, 'resampled.nii')
 
-        # Splitting bold file into lists of single volumes
-        [bold_volumes, num_volumes] = split_volumes(
-            self.inputs.in_file, "bold_", self.inputs.rabies_data_type)
+        ref_img = os.path.abspath('resampled.nii')
 
-        if self.inputs.apply_motcorr:
-            motcorr_params = self.inputs.motcorr_params
-        ref_img = os.path.abspath('resampled.nii.gz')
-        warped_volumes = []
+        if not self.inputs.apply_motcorr:
+            # without motion realignment, the same transforms apply to every volume, so the whole
+            # timeseries is resampled in a single call, computed in single precision unless float64 is
+            # required, and written in the specified data type. The 4D output is handed directly to Merge.
+            warped_bold = os.path.abspath('deformed_bold.nii')
+            exec_applyTransforms(self.inputs.transforms, self.inputs.inverses, self.inputs.in_file, ref_img, warped_bold,
+                                 interpolation=self.inputs.interpolation, num_threads=self.inputs.n_procs,
+                                 output_data_type=ants_data_types[self.inputs.rabies_data_type],
+                                 single_precision=(not self.inputs.rabies_data_type == sitk.sitkFloat64), time_series=True)
 
-        orig_transforms = self.inputs.transforms
-        orig_inverses = self.inputs.inverses
-        for x in range(0, num_volumes):
-            warped_vol_fname = os.path.abspath(
-                "deformed_volume" + str(x) + ".nii.gz")
-            warped_volumes.append(warped_vol_fname)
+            setattr(self, 'out_files', [warped_bold])
+            return runtime
 
-            if self.inputs.apply_motcorr:
-                command = f'antsMotionCorrStats -m {motcorr_params} -o motcorr_vol{x}.mat -t {x}'
-                rc,c_out = run_command(command)
-
-                transforms = orig_transforms+[f'motcorr_vol{x}.mat']
-                inverses = orig_inverses+[0]
-            else:
-                transforms = orig_transforms
-                inverses = orig_inverses
+        # Splitting bold file into lists of single volumes
+        [bold_volumes, num_volumes] = split_volumes(
+            self.inputs.in_file, "bold_", self.inputs.rabies_data_type)
 
-            exec_applyTransforms(transforms, inverses, bold_volumes[x], ref_img, warped_vol_fname, interpolation=self.inputs.interpolation)
-            # change image to specified data type
-            sitk.WriteImage(sitk.ReadImage(warped_vol_fname,
-                                           self.inputs.rabies_data_type), warped_vol_fname)
+        # each volume is resampled independently, so the volumes are distributed across processes
+        import multiprocessing as mp
+        # limit ITK's own multithreading when antsApplyTransforms calls run in parallel
+        num_threads = 1 if self.inputs.n_procs > 1 else None
+        with mp.Pool(processes=self.inputs.n_procs) as pool:
+            results = [pool.apply_async(apply_volume_transforms, args=(
+                x, bold_volumes[x], ref_img, self.inputs.transforms, self.inputs.inverses, self.inputs.motcorr_params,
+                self.inputs.interpolation, num_threads)) for x in range(0, num_volumes)]
+            # the results are listed in the order of the volumes
+            warped_volumes = [p.get() for p in results]
 
         setattr(self, 'out_files', warped_volumes)
         return runtime
@@ -228,7 +253,29 @@ class slice_applyTransforms(BaseInterface):
         return {'out_files': getattr(self, 'out_files')}
 
 
-def exec_applyTransforms(transforms, inverses, input_image, ref_image, output_image, interpolation):
+def apply_volume_transforms(x, bold_volume, ref_img, transforms, inverses, motcorr_params, interpolation, num_threads=None):
+    # applies the transforms to a single volume x, together with its motion realignment if motcorr_params is provided
+    warped_vol_fname = os.path.abspath(
+        "deformed_volume" + str(x) + ".nii")
+
+    if motcorr_params is not None:
+        command = f'antsMotionCorrStats -m {motcorr_params} -o motcorr_vol{x}.mat -t {x}'
+        rc,c_out = run_command(command)
+
+        transforms = transforms+[f'motcorr_vol{x}.mat']
+        inverses = inverses+[0]
+
+    # the volumes are cast to the specified data type when they are read by Merge
+    exec_applyTransforms(transforms, inverses, bold_volume, ref_img, warped_vol_fname, interpolation=interpolation, num_threads=num_threads)
+    return warped_vol_fname
+
+
+# antsApplyTransforms output types corresponding to the SimpleITK data types available with --data_type
+ants_data_types = {sitk.sitkInt16: 'short', sitk.sitkInt32: 'int',
+                   sitk.sitkFloat32: 'float', sitk.sitkFloat64: 'double'}
+
+
+def exec_applyTransforms(transforms, inverses, input_image, ref_image, output_image, interpolation, num_threads=None, output_data_type=None, single_precision=False, time_series=False):
     # tranforms is a list of transform files, set in order of call within antsApplyTransforms
     transform_string = ""
     for transform, inverse in zip(transforms, inverses):
@@ -240,6 +287,18 @@ def exec_applyTransforms(transforms, inverses, input_image, ref_image, output_im
             transform_string += f"-t {transform} "
 
     command = f'antsApplyTransforms -i {input_image} {transform_string}-n {interpolation} -r {ref_image} -o {output_image}'
+    if time_series:
+        # apply the 3D transforms to each volume of a 4D input
+        command += ' -d 3 -e 3'
+    if single_precision:
+        # compute in float instead of double
+        command += ' --float 1'
+    if output_data_type is not None:
+        # write the output directly with the given data type (e.g. 'short'), instead of casting it afterwards
+        command += f' -u {output_data_type}'
+    if num_threads is not None:
+        # limit the number of ITK threads, e.g. when several calls run in parallel
+        command = f'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS={num_threads} '+command
     rc,c_out = run_command(command)
     if not os.path.isfile(output_image):
         raise ValueError(
@@ -258,11 +317,13 @@ def split_volumes(in_file, output_prefix, rabies_data_type):
     if num_dimensions != 4:
         raise ValueError("the input file must be of dimensions 4")
 
+    # the array is extracted once, rather than copying the whole timeseries for every volume
+    data_array = sitk.GetArrayViewFromImage(in_nii)
     volumes = []
     for x in range(0, num_volumes):
-        data_slice = sitk.GetArrayFromImage(in_nii)[x, :, :, :]
+        data_slice = data_array[x, :, :, :]
         slice_fname = os.path.abspath(
-            output_prefix + "vol" + str(x) + ".nii.gz")
+            output_prefix + "vol" + str(x) + ".nii")
         image_3d = copyInfo_3DImage(sitk.GetImageFromArray(
             data_slice, isVector=False), in_nii)
         sitk.WriteImage(image_3d, slice_fname)
@@ -280,6 +341,8 @@ class MergeInputSpec(BaseInterfaceInputSpec):
         desc="Whether to clip out negative values.")
     rabies_data_type = traits.Int(mandatory=True,
                                   desc="Integer specifying SimpleITK data type.")
+    n_procs = traits.Int(1, usedefault=True,
+                         desc="Number of processors available to read volumes in parallel.")
 
 
 class MergeOutputSpec(TraitedSpec):
@@ -288,7 +351,8 @@ class MergeOutputSpec(TraitedSpec):
 
 class Merge(BaseInterface):
     """
-    Takes a list of 3D Nifti files and merge them in the order listed.
+    Takes a list of 3D Nifti files and merge them in the order listed. If a single 4D Nifti file is
+    provided, it is used directly as the timeseries.
     """
 
     input_spec = MergeInputSpec
@@ -300,17 +364,21 @@ class Merge(BaseInterface):
 
         sample_volume = sitk.ReadImage(
             self.inputs.in_files[0], self.inputs.rabies_data_type)
-        length = len(self.inputs.in_files)
-        shape = sitk.GetArrayFromImage(sample_volume).shape
-        combined = np.zeros((length, shape[0], shape[1], shape[2]))
-
-        i = 0
-        for file in self.inputs.in_files:
-            combined[i, :, :, :] = sitk.GetArrayFromImage(
-                sitk.ReadImage(file, self.inputs.rabies_data_type))[:, :, :]
-            i = i+1
-        if (i != length):
-            raise ValueError("Error occured with Merge.")
+        if sample_volume.GetDimension() == 4:
+            combined = sitk.GetArrayFromImage(sample_volume)
+        else:
+            sample_array = sitk.GetArrayViewFromImage(sample_volume)
+            # the volumes are read concurrently and written directly into the 4D array, in the specified data type
+            combined = np.empty((len(self.inputs.in_files),)+sample_array.shape, dtype=sample_array.dtype)
+
+            def read_volume(i):
+                volume_img = sitk.ReadImage(self.inputs.in_files[i], self.inputs.rabies_data_type)
+                combined[i, :, :, :] = sitk.GetArrayViewFromImage(volume_img)
+
+            combined[0, :, :, :] = sample_array
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=self.inputs.n_procs) as executor:
+                list(executor.map(read_volume, range(1, len(self.inputs.in_files))))
         combined_files = os.path.abspath(
             f"{filename_split[0]}_combined.nii.gz")
 
@@ -320,8 +388,7 @@ class Merge(BaseInterface):
         combined_image = sitk.GetImageFromArray(combined, isVector=False)
 
         # set metadata and affine for the newly constructed 4D image
-        header_source = sitk.ReadImage(
-            self.inputs.header_source, self.inputs.rabies_data_type)
+        header_source = read_image_info(self.inputs.header_source)
         combined_image = copyInfo_4DImage(
             combined_image, sample_volume, header_source)
         sitk.WriteImage(combined_image, combined_files)
@@ -524,37 +591,40 @@ def generate_token_data(tmppath, number_scans):
     # generate template masks
     resampled_mask = resample_image_spacing(sitk.ReadImage(mask), spacing)
     array = sitk.GetArrayFromImage(resampled_mask)
-    array[array < 1] = 0
-    array[array > 1] = 1
+    array = (array >= 1).astype(array.dtype)
     binarized = sitk.GetImageFromArray(array, isVector=False)
     binarized.CopyInformation(resampled_mask)
-    sitk.WriteImage(binarized, tmppath+'/inputs/token_mask.nii.gz')
+    sitk.WriteImage(binarized, tmppath+'/inputs/token_mask.nii')
     array[:, :, :6] = 0
     binarized = sitk.GetImageFromArray(array, isVector=False)
     binarized.CopyInformation(resampled_mask)
-    sitk.WriteImage(binarized, tmppath+'/inputs/token_mask_half.nii.gz')
+    sitk.WriteImage(binarized, tmppath+'/inputs/token_mask_half.nii')
 
     # generate fake scans from the template
-    array = sitk.GetArrayFromImage(resampled_template)
-    array_4d = np.repeat(array[np.newaxis, :, :, :], 15, axis=0)
+    # the fake scans are generated in float32 to halve the memory footprint and file size
+    array = sitk.GetArrayFromImage(resampled_template).astype(np.float32)
+    num_timepoints = 15
+    shape_4d = (num_timepoints,)+array.shape
     
     melodic_img = sitk.ReadImage(melodic_file)
-    network1_map = sitk.GetArrayFromImage(sitk.Resample(melodic_img[:,:,:,5], resampled_template))
-    network2_map = sitk.GetArrayFromImage(sitk.Resample(melodic_img[:,:,:,19], resampled_template))
-    time1 = np.random.normal(0, array_4d.mean()/100, array_4d.shape[0]) # network timecourse; scale is 1% of image intensity
-    time2 = np.random.normal(0, array_4d.mean()/100, array_4d.shape[0]) # network timecourse; scale is 1% of image intensity
-    # creating fake network timeseries
-    network1_time = (np.repeat(network1_map[np.newaxis, :, :, :], 15, axis=0).T*time1).T
-    network2_time = (np.repeat(network2_map[np.newaxis, :, :, :], 15, axis=0).T*time2).T
-
+    network1_map = sitk.GetArrayFromImage(sitk.Resample(melodic_img[:,:,:,5], resampled_template)).astype(np.float32)
+    network2_map = sitk.GetArrayFromImage(sitk.Resample(melodic_img[:,:,:,19], resampled_template)).astype(np.float32)
+    time1 = np.random.normal(0, array.mean()/100, num_timepoints).astype(np.float32) # network timecourse; scale is 1% of image intensity
+    time2 = np.random.normal(0, array.mean()/100, num_timepoints).astype(np.float32) # network timecourse; scale is 1% of image intensity
+    # creating fake network timeseries, broadcasting the template across time
+    signal_4d = array[np.newaxis, :, :, :] + time1[:, np.newaxis, np.newaxis, np.newaxis]*network1_map[np.newaxis, :, :, :]
+    signal_4d += time2[:, np.newaxis, np.newaxis, np.newaxis]*network2_map[np.newaxis, :, :, :]
+
+    # generate anatomical scan; it is encoded once, then copied for the other subjects
+    import shutil
+    sitk.WriteImage(resampled_template, tmppath+'/inputs/sub-token1_T1w.nii')
     for i in range(number_scans):
-        # generate anatomical scan
-        sitk.WriteImage(resampled_template, tmppath+f'/inputs/sub-token{i+1}_T1w.nii.gz')
+        if i > 0:
+            shutil.copyfile(tmppath+'/inputs/sub-token1_T1w.nii', tmppath+f'/inputs/sub-token{i+1}_T1w.nii')
         # generate functional scan
-        array_4d_ = array_4d + network1_time + network2_time + np.random.normal(0, array_4d.mean()/ 100, array_4d.shape)  # add gaussian noise; scale is 1% of the mean intensity of the template
-        sitk.WriteImage(sitk.GetImageFromArray(array_4d_, isVector=False),
-                        tmppath+f'/inputs/sub-token{i+1}_bold.nii.gz')
-
+        array_4d_ = np.random.normal(0, array.mean()/ 100, shape_4d).astype(np.float32)  # add gaussian noise; scale is 1% of the mean intensity of the template
+        array_4d_ += signal_4d
+        bold_img = sitk.GetImageFromArray(array_4d_, isVector=False)
         # necessary to read matrix orientation properly at the analysis stage
-        sitk.WriteImage(copyInfo_4DImage(sitk.ReadImage(tmppath+f'/inputs/sub-token{i+1}_bold.nii.gz'), sitk.ReadImage(tmppath
-                        + f'/inputs/sub-token{i+1}_T1w.nii.gz'), sitk.ReadImage(tmppath+f'/inputs/sub-token{i+1}_bold.nii.gz')), tmppath+f'/inputs/sub-token{i+1}_bold.nii.gz')
+        bold_img = copyInfo_4DImage(bold_img, resampled_template, bold_img)
+        sitk.WriteImage(bold_img, tmppath+f'/inputs/sub-token{i+1}_bold.nii')
@@ -13,7 +13,7 @@ output_folder = f'{tmppath}/outputs'
 
 #### HERE ARE SET THE DESIRED PARAMETERS FOR PREPROCESSING
 args = [
-        f'--exclusion_ids',f'{tmppath}/inputs/sub-token1_bold.nii.gz',
+        f'--exclusion_ids',f'{tmppath}/inputs/sub-token1_bold.nii',
         '-f',
         #'--debug',
         'preprocess', f'{tmppath}/inputs', output_folder,
@@ -22,12 +22,12 @@ args = [
         '--bold2anat_coreg', 'registration=no_reg,masking=false,brain_extraction=false', 
         '--commonspace_reg', 'masking=false,brain_extraction=false,fast_commonspace=true,template_registration=no_reg', 
         '--data_type', 'int16', 
-        '--anat_template', f'{tmppath}/inputs/sub-token1_T1w.nii.gz',
-        '--brain_mask', f'{tmppath}/inputs/token_mask.nii.gz', 
-        '--WM_mask', f'{tmppath}/inputs/token_mask.nii.gz',
-        '--CSF_mask', f'{tmppath}/inputs/token_mask.nii.gz',
-        '--vascular_mask', f'{tmppath}/inputs/token_mask.nii.gz', 
-        '--labels', f'{tmppath}/inputs/token_mask.nii.gz',
+        '--anat_template', f'{tmppath}/inputs/sub-token1_T1w.nii',
+        '--brain_mask', f'{tmppath}/inputs/token_mask.nii', 
+        '--WM_mask', f'{tmppath}/inputs/token_mask.nii',
+        '--CSF_mask', f'{tmppath}/inputs/token_mask.nii',
+        '--vascular_mask', f'{tmppath}/inputs/token_mask.nii', 
+        '--labels', f'{tmppath}/inputs/token_mask.nii',
         ]
 
 execute_workflow(args=args)
@@ -37,7 +37,7 @@ execute_workflow(args=args)
 '''
 
 args = [
-        f'--exclusion_ids',f'{tmppath}/inputs/sub-token1_bold.nii.gz',f'{tmppath}/inputs/sub-token2_bold.nii.gz',
+        f'--exclusion_ids',f'{tmppath}/inputs/sub-token1_bold.nii',f'{tmppath}/inputs/sub-token2_bold.nii',
         '-f',
         'confound_correction', output_folder, output_folder,
         '--nativespace_analysis',
@@ -46,7 +46,7 @@ execute_workflow(args=args)
 
 
 args = [
-        f'--exclusion_ids',f'{tmppath}/inputs/sub-token3_bold.nii.gz',
+        f'--exclusion_ids',f'{tmppath}/inputs/sub-token3_bold.nii',
         '-f',
         'analysis', output_folder, output_folder,
         '--data_diagnosis'
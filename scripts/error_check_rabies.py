@@ -56,9 +56,9 @@ def get_parser():
             "If the preprocessing stage is run, the following arguments are automatically \n"
             "provided to ensure compatibility with token data:\n"
             "   --anat_inho_cor method=disable,otsu_thresh=2,multiotsu=false --bold_inho_cor method=disable,otsu_thresh=2,multiotsu=false \ \n"
-            "   --anat_template {tmppath}/inputs/sub-token1_T1w.nii.gz --brain_mask {tmppath}/inputs/token_mask.nii.gz  \ \n"
-            "   --WM_mask {tmppath}/inputs/token_mask.nii.gz --CSF_mask {tmppath}/inputs/token_mask.nii.gz  \ \n"
-            "   --vascular_mask {tmppath}/inputs/token_mask.nii.gz --labels {tmppath}/inputs/token_mask.nii.gz \ \n"
+            "   --anat_template {tmppath}/inputs/sub-token1_T1w.nii --brain_mask {tmppath}/inputs/token_mask.nii  \ \n"
+            "   --WM_mask {tmppath}/inputs/token_mask.nii --CSF_mask {tmppath}/inputs/token_mask.nii  \ \n"
+            "   --vascular_mask {tmppath}/inputs/token_mask.nii --labels {tmppath}/inputs/token_mask.nii \ \n"
             "   --bold2anat_coreg registration=no_reg,masking=false,brain_extraction=false,keep_mask_after_extract=false \ \n"
             "   --commonspace_reg masking=false,brain_extraction=false,keep_mask_after_extract=false,fast_commonspace=true,template_registration=no_reg --data_type int16 \n"
         )
@@ -76,8 +76,8 @@ else:
 generate_token_data(tmppath, number_scans=3)
 
 if not opts.custom is None:
-    minimal_preproc = f"rabies --inclusion_ids {tmppath}/inputs/sub-token1_bold.nii.gz --verbose 1 preprocess {tmppath}/inputs {tmppath}/outputs --anat_inho_cor method=disable,otsu_thresh=2,multiotsu=false --bold_inho_cor method=disable,otsu_thresh=2,multiotsu=false \
-        --anat_template {tmppath}/inputs/sub-token1_T1w.nii.gz --brain_mask {tmppath}/inputs/token_mask.nii.gz --WM_mask {tmppath}/inputs/token_mask.nii.gz --CSF_mask {tmppath}/inputs/token_mask.nii.gz --vascular_mask {tmppath}/inputs/token_mask.nii.gz --labels {tmppath}/inputs/token_mask.nii.gz \
+    minimal_preproc = f"rabies --inclusion_ids {tmppath}/inputs/sub-token1_bold.nii --verbose 1 preprocess {tmppath}/inputs {tmppath}/outputs --anat_inho_cor method=disable,otsu_thresh=2,multiotsu=false --bold_inho_cor method=disable,otsu_thresh=2,multiotsu=false \
+        --anat_template {tmppath}/inputs/sub-token1_T1w.nii --brain_mask {tmppath}/inputs/token_mask.nii --WM_mask {tmppath}/inputs/token_mask.nii --CSF_mask {tmppath}/inputs/token_mask.nii --vascular_mask {tmppath}/inputs/token_mask.nii --labels {tmppath}/inputs/token_mask.nii \
         --bold2anat_coreg registration=no_reg,masking=false,brain_extraction=false,keep_mask_after_extract=false --commonspace_reg masking=false,brain_extraction=false,keep_mask_after_extract=false,fast_commonspace=true,template_registration=no_reg --data_type int16"
     minimal_cc = f"rabies --verbose 1 confound_correction {tmppath}/outputs {tmppath}/outputs"
 
@@ -85,7 +85,7 @@ if not opts.custom is None:
     command = opts.custom
     if 'preprocess' in command:
         command += f" --anat_inho_cor method=disable,otsu_thresh=2,multiotsu=false --bold_inho_cor method=disable,otsu_thresh=2,multiotsu=false \
-    --anat_template {tmppath}/inputs/sub-token1_T1w.nii.gz --brain_mask {tmppath}/inputs/token_mask.nii.gz --WM_mask {tmppath}/inputs/token_mask.nii.gz --CSF_mask {tmppath}/inputs/token_mask.nii.gz --vascular_mask {tmppath}/inputs/token_mask.nii.gz --labels {tmppath}/inputs/token_mask.nii.gz \
+    --anat_template {tmppath}/inputs/sub-token1_T1w.nii --brain_mask {tmppath}/inputs/token_mask.nii --WM_mask {tmppath}/inputs/token_mask.nii --CSF_mask {tmppath}/inputs/token_mask.nii --vascular_mask {tmppath}/inputs/token_mask.nii --labels {tmppath}/inputs/token_mask.nii \
     --bold2anat_coreg registration=no_reg,masking=false,brain_extraction=false,keep_mask_after_extract=false --commonspace_reg masking=false,brain_extraction=false,keep_mask_after_extract=false,fast_commonspace=true,template_registration=no_reg --data_type int16"
         command += f" {tmppath}/inputs {tmppath}/outputs"
         
@@ -114,25 +114,22 @@ if not opts.custom is None:
         )
     sys.exit()
 
-command = f"rabies --exclusion_ids {tmppath}/inputs/sub-token2_bold.nii.gz {tmppath}/inputs/sub-token3_bold.nii.gz --force --verbose 1 preprocess {tmppath}/inputs {tmppath}/outputs --anat_inho_cor method=disable,otsu_thresh=2,multiotsu=false --bold_inho_cor method=disable,otsu_thresh=2,multiotsu=false \
-    --anat_template {tmppath}/inputs/sub-token1_T1w.nii.gz --brain_mask {tmppath}/inputs/token_mask.nii.gz --WM_mask {tmppath}/inputs/token_mask.nii.gz --CSF_mask {tmppath}/inputs/token_mask.nii.gz --vascular_mask {tmppath}/inputs/token_mask.nii.gz --labels {tmppath}/inputs/token_mask.nii.gz \
+# the --bold_only run is independent from the following stages, so it is written to a separate output folder
+# and run in parallel with the next preprocessing run
+bold_only_command = f"rabies --exclusion_ids {tmppath}/inputs/sub-token2_bold.nii {tmppath}/inputs/sub-token3_bold.nii --force --verbose 1 preprocess {tmppath}/inputs {tmppath}/outputs_bold_only --anat_inho_cor method=disable,otsu_thresh=2,multiotsu=false --bold_inho_cor method=disable,otsu_thresh=2,multiotsu=false \
+    --anat_template {tmppath}/inputs/sub-token1_T1w.nii --brain_mask {tmppath}/inputs/token_mask.nii --WM_mask {tmppath}/inputs/token_mask.nii --CSF_mask {tmppath}/inputs/token_mask.nii --vascular_mask {tmppath}/inputs/token_mask.nii --labels {tmppath}/inputs/token_mask.nii \
     --bold2anat_coreg registration=no_reg,masking=false,brain_extraction=false,keep_mask_after_extract=false --commonspace_reg masking=false,brain_extraction=false,keep_mask_after_extract=false,fast_commonspace=true,template_registration=no_reg --data_type int16 --bold_only --detect_dummy \
     --tpattern seq-z --apply_STC --voxelwise_motion --isotropic_HMC --interp_method linear --nativespace_resampling 1x1x1 --commonspace_resampling 1x1x1 --anatomical_resampling 1x1x1 --oblique2card 3dWarp"
-process = subprocess.run(
-    command,
-    check=True,
-    shell=True,
-    )
 
-command = f"rabies --inclusion_ids {tmppath}/inputs/sub-token1_bold.nii.gz --verbose 1 --force preprocess {tmppath}/inputs {tmppath}/outputs --anat_inho_cor method=disable,otsu_thresh=2,multiotsu=false --bold_inho_cor method=disable,otsu_thresh=2,multiotsu=false \
-    --anat_template {tmppath}/inputs/sub-token1_T1w.nii.gz --brain_mask {tmppath}/inputs/token_mask.nii.gz --WM_mask {tmppath}/inputs/token_mask.nii.gz --CSF_mask {tmppath}/inputs/token_mask.nii.gz --vascular_mask {tmppath}/inputs/token_mask.nii.gz --labels {tmppath}/inputs/token_mask.nii.gz \
+command = f"rabies --inclusion_ids {tmppath}/inputs/sub-token1_bold.nii --verbose 1 --force preprocess {tmppath}/inputs {tmppath}/outputs --anat_inho_cor method=disable,otsu_thresh=2,multiotsu=false --bold_inho_cor method=disable,otsu_thresh=2,multiotsu=false \
+    --anat_template {tmppath}/inputs/sub-token1_T1w.nii --brain_mask {tmppath}/inputs/token_mask.nii --WM_mask {tmppath}/inputs/token_mask.nii --CSF_mask {tmppath}/inputs/token_mask.nii --vascular_mask {tmppath}/inputs/token_mask.nii --labels {tmppath}/inputs/token_mask.nii \
     --bold2anat_coreg registration=no_reg,masking=true,brain_extraction=true,keep_mask_after_extract=false --commonspace_reg masking=true,brain_extraction=true,keep_mask_after_extract=false,fast_commonspace=true,template_registration=no_reg --data_type int16  \
     --HMC_option 0 --apply_despiking --anat_autobox --bold_autobox --oblique2card affine"
-process = subprocess.run(
-    command,
-    check=True,
-    shell=True,
-    )
+processes = [subprocess.Popen(c, shell=True) for c in [bold_only_command, command]]
+returncodes = [process.wait() for process in processes]
+for process, rc in zip(processes, returncodes):
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, process.args)
 
 command = f"rabies --force --verbose 1 confound_correction {tmppath}/outputs {tmppath}/outputs --conf_list aCompCor_5 --nativespace_analysis"
 process = subprocess.run(
@@ -197,7 +194,7 @@ if opts.complete:
 
     ####GROUP LEVEL, RUNNING ALL 3 SCANS####
     command = f"rabies --force --verbose 1 preprocess {tmppath}/inputs {tmppath}/outputs --anat_inho_cor method=disable,otsu_thresh=2,multiotsu=false --bold_inho_cor method=disable,otsu_thresh=2,multiotsu=false \
-        --anat_template {tmppath}/inputs/sub-token1_T1w.nii.gz --brain_mask {tmppath}/inputs/token_mask.nii.gz --WM_mask {tmppath}/inputs/token_mask_half.nii.gz --CSF_mask {tmppath}/inputs/token_mask_half.nii.gz --vascular_mask {tmppath}/inputs/token_mask_half.nii.gz --labels {tmppath}/inputs/token_mask.nii.gz \
+        --anat_template {tmppath}/inputs/sub-token1_T1w.nii --brain_mask {tmppath}/inputs/token_mask.nii --WM_mask {tmppath}/inputs/token_mask_half.nii --CSF_mask {tmppath}/inputs/token_mask_half.nii --vascular_mask {tmppath}/inputs/token_mask_half.nii --labels {tmppath}/inputs/token_mask.nii \
         --bold2anat_coreg registration=no_reg,masking=false,brain_extraction=false,keep_mask_after_extract=false --commonspace_reg masking=false,brain_extraction=false,keep_mask_after_extract=false,fast_commonspace=true,template_registration=no_reg --data_type int16  \
         --HMC_option 0"
     process = subprocess.run(
@@ -215,7 +212,7 @@ if opts.complete:
 
     # testing group level --data_diagnosis
     command = f"rabies --force --verbose 1 analysis {tmppath}/outputs {tmppath}/outputs --NPR_temporal_comp 1 \
-        --data_diagnosis --group_avg_prior --extended_QC --DR_ICA --seed_list {tmppath}/inputs/token_mask_half.nii.gz"
+        --data_diagnosis --group_avg_prior --extended_QC --DR_ICA --seed_list {tmppath}/inputs/token_mask_half.nii"
     process = subprocess.run(
         command,
         check=True,